@@ -1,19 +1,19 @@
 #!/usr/bin/env python3
 """
 Telegram Bot for formatting episode links - Webhook Version for Render
-Install dependencies: pip install python-telegram-bot flask
+Install dependencies: pip install "python-telegram-bot[webhooks]"
 Run: python3 bot.py
 """
 
 import re
 import logging
 import os
-from flask import Flask, request
-from telegram import Update
+from itertools import chain, groupby
+from operator import itemgetter
+from telegram import LinkPreviewOptions, Update
 from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
 from telegram.constants import ParseMode
 import asyncio
-from threading import Thread
 
 # Configure logging
 logging.basicConfig(
@@ -26,96 +26,153 @@ logger = logging.getLogger(__name__)
 BOT_TOKEN = os.environ.get("BOT_TOKEN", "YOUR_BOT_TOKEN_HERE")
 WEBHOOK_URL = os.environ.get("RENDER_EXTERNAL_URL", "")  # Render provides this
 PORT = int(os.environ.get("PORT", 10000))  # Render provides this
+ACK_DELAY = 2.0  # Seconds to batch pasted messages into one acknowledgement
+ACK_WRITE_TIMEOUT = 2.0  # Seconds allowed to send an acknowledgement (PTB default is 5)
+SESSION_TTL = int(os.environ.get("SESSION_TTL", 3600))  # Seconds before an unfinished upload expires
+MAX_MESSAGES = int(os.environ.get("MAX_MESSAGES", 200))  # Pasted messages kept per upload session
 
-# Store user data temporarily
-user_sessions = {}
+# Precompiled patterns and translation tables
+# (each span bounded by [^\n] so a match never crosses lines)
+_EPISODE_RE = re.compile(r'S(\d+)-E(\d+)[^\n]*?(480|720|1080)[^\n]*?(https://t\.me/\S+)')
+_BOLD_NUMS = str.maketrans('0123456789', '𝟎𝟏𝟐𝟑𝟒𝟓𝟔𝟕𝟖𝟗')
 
-# Flask app for webhook
-app = Flask(__name__)
+# Quality labels are constant, so render them once
+_BOLD_Q = {q: f"{q}𝐏".translate(_BOLD_NUMS) for q in ('480', '720', '1080')}
+_STRIKE_Q = {q: f"<s>{label}</s>" for q, label in _BOLD_Q.items()}
 
-# Bot application (will be initialized)
-application = None
-bot_loop = None
+# Shared by every reply that carries links
+_NO_PREVIEW = LinkPreviewOptions(is_disabled=True)
+
+# Static replies
+_WELCOME_MSG = (
+    "👋 <b>Welcome to Episode Link Formatter Bot!</b>\n\n"
+    "📝 <b>How to use:</b>\n"
+    "1. Use /upload to start collecting links\n"
+    "2. Forward/paste all your bulk upload messages (480p, 720p, 1080p)\n"
+    "3. Use /format to generate the formatted output\n"
+    "4. Use /cancel to cancel current upload session\n\n"
+    "Type /help for more details!"
+)
+
+_HELP_TEXT = (
+    "📚 <b>Help Guide:</b>\n\n"
+    "<b>Commands:</b>\n"
+    "/upload - Start collecting episode links\n"
+    "/format - Generate formatted output\n"
+    "/cancel - Cancel current session\n"
+    "/clear - Clear all collected links\n"
+    "/status - Check current session status\n\n"
+    "<b>Workflow:</b>\n"
+    "1. Send /upload command\n"
+    "2. Paste all three bulk uploads (480p, 720p, 1080p)\n"
+    "3. Send /format to get the final output\n\n"
+    "The bot will combine all qualities into a single formatted output!"
+)
 
 def parse_bulk_output(text):
-    """Parse the bulk upload output and extract episode links by quality"""
-    episodes = {}
-    pattern = r'S(\d+)-E(\d+).*?(480|720|1080).*?(https://t\.me/[^\s]+)'
-    matches = re.finditer(pattern, text)
+    """Parse the bulk upload output and yield (episode, quality, url) records"""
+    for _, episode, quality, url in _EPISODE_RE.findall(text):
+        yield int(episode), quality, url
+
+def _format_line(episode, qualities):
+    """Render a single episode line, striking out missing qualities"""
+    # The layout always has the same three slots, so they are unrolled by hand
+    url = qualities.get('480')
+    link_480 = f'<a href="{url}">{_BOLD_Q["480"]}</a>' if url else _STRIKE_Q['480']
+    url = qualities.get('720')
+    link_720 = f'<a href="{url}">{_BOLD_Q["720"]}</a>' if url else _STRIKE_Q['720']
+    url = qualities.get('1080')
+    link_1080 = f'<a href="{url}">{_BOLD_Q["1080"]}</a>' if url else _STRIKE_Q['1080']
     
-    for match in matches:
-        season = match.group(1)
-        episode = match.group(2)
-        quality = match.group(3)
-        url = match.group(4).strip()
-        
-        ep_key = f"E{episode.zfill(2)}"
-        
-        if ep_key not in episodes:
-            episodes[ep_key] = {}
-        
-        episodes[ep_key][quality] = url
+    bold_ep = f"E{episode:02d}".translate(_BOLD_NUMS)
+    return f"➪ {bold_ep}      {link_480}      {link_720}       {link_1080}"
+
+def format_output(records):
+    """Format episode records into output lines with hyperlinks"""
+    # Stable sort on episode only, so a repeated quality keeps its last link
+    records = sorted(records, key=itemgetter(0))
+    return [
+        _format_line(episode, {quality: url for _, quality, url in group})
+        for episode, group in groupby(records, key=itemgetter(0))
+    ]
+
+def _cancel_pending_ack(session):
+    """Cancel a scheduled collection acknowledgement, if any"""
+    task = session.pop('pending_ack_task', None)
+    if task is not None:
+        task.cancel()
+
+def _end_session(session):
+    """Stop a session's background tasks and drop its collected data"""
+    _cancel_pending_ack(session)
+    task = session.pop('expiry_task', None)
+    if task is not None:
+        task.cancel()
+    session.clear()
+
+async def _expire_session(application, user_id, chat_id, delay=SESSION_TTL):
+    """Drop an upload session that was never formatted or cancelled"""
+    await asyncio.sleep(delay)
     
-    return episodes
+    session = application.user_data.get(user_id)
+    if session is not None:
+        session.pop('expiry_task', None)
+        _end_session(session)
+    application.drop_user_data(user_id)
+    logger.info("User %s upload session expired", user_id)
+    
+    # Later pastes are ignored silently, so say why
+    try:
+        await application.bot.send_message(
+            chat_id,
+            "⌛ Upload session expired and collected links were discarded.\n"
+            "Use /upload to start a new session.",
+            parse_mode=ParseMode.HTML
+        )
+    except Exception as e:
+        logger.error("Error notifying expired session: %s", e)
 
-def format_output(episodes):
-    """Format episodes into the desired output with hyperlinks"""
-    output_lines = []
-    sorted_eps = sorted(episodes.items(), key=lambda x: int(x[0][1:]))
-    bold_nums = str.maketrans('0123456789', '𝟎𝟏𝟐𝟑𝟒𝟓𝟔𝟕𝟖𝟗')
+async def _flush_ack(bot, chat_id, session, delay=ACK_DELAY):
+    """Acknowledge every message collected during the debounce window at once"""
+    await asyncio.sleep(delay)
     
-    for ep_num, qualities in sorted_eps:
-        quality_links = []
-        
-        for quality in ['480', '720', '1080']:
-            if quality in qualities:
-                bold_quality = f"{quality}𝐏".translate(bold_nums)
-                quality_links.append(f'<a href="{qualities[quality]}">{bold_quality}</a>')
-            else:
-                bold_quality = f"{quality}𝐏".translate(bold_nums)
-                quality_links.append(f"<s>{bold_quality}</s>")
-        
-        bold_ep = ep_num.translate(bold_nums)
-        line = f"➪ {bold_ep}      {quality_links[0]}      {quality_links[1]}       {quality_links[2]}"
-        output_lines.append(line)
+    if not session.get('collecting', False):
+        return
+    
+    session.pop('pending_ack_task', None)
+    msg_count = len(session['messages'])
     
-    return '\n'.join(output_lines)
+    try:
+        # Plain silent message: no reply threading, no notification for an ack,
+        # and a short write timeout since it is small and not worth waiting on
+        await bot.send_message(
+            chat_id,
+            f"✅ Messages collected! ({msg_count} total)\n"
+            f"Continue pasting or use /format when done.",
+            parse_mode=ParseMode.HTML,
+            disable_notification=True,
+            write_timeout=ACK_WRITE_TIMEOUT
+        )
+    except Exception as e:
+        logger.error("Error acknowledging messages: %s", e)
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Send a message when the command /start is issued."""
-    welcome_message = (
-        "👋 <b>Welcome to Episode Link Formatter Bot!</b>\n\n"
-        "📝 <b>How to use:</b>\n"
-        "1. Use /upload to start collecting links\n"
-        "2. Forward/paste all your bulk upload messages (480p, 720p, 1080p)\n"
-        "3. Use /format to generate the formatted output\n"
-        "4. Use /cancel to cancel current upload session\n\n"
-        "Type /help for more details!"
-    )
-    await update.message.reply_text(welcome_message, parse_mode=ParseMode.HTML)
+    await update.message.reply_text(_WELCOME_MSG, parse_mode=ParseMode.HTML)
 
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Send a message when the command /help is issued."""
-    help_text = (
-        "📚 <b>Help Guide:</b>\n\n"
-        "<b>Commands:</b>\n"
-        "/upload - Start collecting episode links\n"
-        "/format - Generate formatted output\n"
-        "/cancel - Cancel current session\n"
-        "/clear - Clear all collected links\n"
-        "/status - Check current session status\n\n"
-        "<b>Workflow:</b>\n"
-        "1. Send /upload command\n"
-        "2. Paste all three bulk uploads (480p, 720p, 1080p)\n"
-        "3. Send /format to get the final output\n\n"
-        "The bot will combine all qualities into a single formatted output!"
-    )
-    await update.message.reply_text(help_text, parse_mode=ParseMode.HTML)
+    await update.message.reply_text(_HELP_TEXT, parse_mode=ParseMode.HTML)
 
 async def upload_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Start upload session"""
     user_id = update.effective_user.id
-    user_sessions[user_id] = {'collecting': True, 'messages': []}
+    _end_session(context.user_data)
+    context.user_data['collecting'] = True
+    context.user_data['messages'] = []
+    context.user_data['expiry_task'] = asyncio.create_task(
+        _expire_session(context.application, user_id, update.effective_chat.id)
+    )
     
     await update.message.reply_text(
         "✅ <b>Upload mode activated!</b>\n\n"
@@ -124,19 +181,20 @@ async def upload_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "When done, use /format to generate the output.",
         parse_mode=ParseMode.HTML
     )
-    logger.info(f"User {user_id} started upload session")
+    logger.info("User %s started upload session", user_id)
 
 async def cancel_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Cancel current upload session"""
     user_id = update.effective_user.id
     
-    if user_id in user_sessions:
-        del user_sessions[user_id]
+    if context.user_data.get('collecting', False):
+        _end_session(context.user_data)
+        context.application.drop_user_data(user_id)
         await update.message.reply_text(
             "❌ Upload session cancelled.\nUse /upload to start a new session.",
             parse_mode=ParseMode.HTML
         )
-        logger.info(f"User {user_id} cancelled upload session")
+        logger.info("User %s cancelled upload session", user_id)
     else:
         await update.message.reply_text(
             "ℹ️ No active upload session.\nUse /upload to start collecting links.",
@@ -145,10 +203,8 @@ async def cancel_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def clear_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Clear collected messages"""
-    user_id = update.effective_user.id
-    
-    if user_id in user_sessions:
-        user_sessions[user_id]['messages'] = []
+    if context.user_data.get('collecting', False):
+        context.user_data['messages'] = []
         await update.message.reply_text(
             "🗑️ All collected links cleared.\n"
             "You can continue pasting new links or use /format with current data.",
@@ -162,10 +218,8 @@ async def clear_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def status_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Check session status"""
-    user_id = update.effective_user.id
-    
-    if user_id in user_sessions and user_sessions[user_id]['collecting']:
-        msg_count = len(user_sessions[user_id]['messages'])
+    if context.user_data.get('collecting', False):
+        msg_count = len(context.user_data.setdefault('messages', []))
         await update.message.reply_text(
             f"📊 <b>Session Status:</b>\n\n"
             f"✅ Upload mode: Active\n"
@@ -184,33 +238,43 @@ async def collect_messages(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Collect messages during upload session"""
     user_id = update.effective_user.id
     
-    if user_id not in user_sessions or not user_sessions[user_id]['collecting']:
+    if not context.user_data.get('collecting', False):
         return
     
-    user_text = update.message.text
-    user_sessions[user_id]['messages'].append(user_text)
-    msg_count = len(user_sessions[user_id]['messages'])
+    messages = context.user_data.setdefault('messages', [])
     
-    await update.message.reply_text(
-        f"✅ Message collected! ({msg_count} total)\n"
-        f"Continue pasting or use /format when done.",
-        parse_mode=ParseMode.HTML
-    )
+    if len(messages) >= MAX_MESSAGES:
+        await update.message.reply_text(
+            f"⚠️ Message limit reached ({MAX_MESSAGES} messages).\n"
+            "Use /format to generate the output or /clear to start over.",
+            parse_mode=ParseMode.HTML
+        )
+        return
     
-    logger.info(f"User {user_id} added message #{msg_count}")
+    messages.append(update.message.text)
+    msg_count = len(messages)
+    
+    # Acknowledge in batches rather than replying to every paste
+    if context.user_data.get('pending_ack_task') is None:
+        context.user_data['pending_ack_task'] = asyncio.create_task(
+            _flush_ack(context.bot, update.effective_chat.id, context.user_data)
+        )
+    
+    logger.info("User %s added message #%s", user_id, msg_count)
 
 async def format_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Format all collected messages into final output"""
     user_id = update.effective_user.id
     
-    if user_id not in user_sessions:
+    if not context.user_data.get('collecting', False):
         await update.message.reply_text(
             "❌ No upload session found.\nUse /upload to start collecting links first.",
             parse_mode=ParseMode.HTML
         )
         return
     
-    messages = user_sessions[user_id]['messages']
+    _cancel_pending_ack(context.user_data)
+    messages = context.user_data.setdefault('messages', [])
     
     if not messages:
         await update.message.reply_text(
@@ -221,10 +285,11 @@ async def format_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     
     try:
-        combined_text = '\n'.join(messages)
-        episodes = parse_bulk_output(combined_text)
+        # Matches never span lines, so each message can be parsed on its own
+        records = chain.from_iterable(parse_bulk_output(msg) for msg in messages)
+        lines = format_output(records)
         
-        if not episodes:
+        if not lines:
             await update.message.reply_text(
                 "❌ No valid episode links found in collected messages.\n"
                 "Please check your input format.",
@@ -232,36 +297,39 @@ async def format_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
             )
             return
         
-        formatted_output = format_output(episodes)
+        formatted_output = '\n'.join(lines)
         header = "✅ <b>Formatted Episode Links:</b>\n\n"
-        footer = f"\n\n📊 Total Episodes: {len(episodes)}"
+        footer = (
+            f"\n\n📊 Total Episodes: {len(lines)}"
+            "\n\n🎉 Session completed! Use /upload to start a new one."
+        )
         full_output = header + formatted_output + footer
         
+        # Session is finished either way; drop it before the (only) send
+        _end_session(context.user_data)
+        context.application.drop_user_data(user_id)
+        
         await update.message.reply_text(
             full_output,
             parse_mode=ParseMode.HTML,
-            disable_web_page_preview=True
+            link_preview_options=_NO_PREVIEW
         )
         
-        logger.info(f"Formatted {len(episodes)} episodes for user {user_id}")
-        del user_sessions[user_id]
-        
-        await update.message.reply_text(
-            "🎉 Session completed! Use /upload to start a new one.",
-            parse_mode=ParseMode.HTML
-        )
+        logger.info("Formatted %s episodes for user %s", len(lines), user_id)
         
     except Exception as e:
-        logger.error(f"Error formatting links: {e}")
+        logger.error("Error formatting links: %s", e)
+        # The session may already be gone if the send itself failed; end it either way
+        _end_session(context.user_data)
+        context.application.drop_user_data(user_id)
         await update.message.reply_text(
             f"❌ An error occurred while formatting:\n{str(e)}\n\n"
-            "Please try again or use /cancel to reset.",
+            "This upload session has ended. Use /upload to start a new one.",
             parse_mode=ParseMode.HTML
         )
 
-async def initialize_bot():
-    """Initialize the bot application"""
-    global application
+def build_application():
+    """Build the bot application and register handlers"""
     application = Application.builder().token(BOT_TOKEN).build()
     
     # Register handlers
@@ -274,58 +342,28 @@ async def initialize_bot():
     application.add_handler(CommandHandler("status", status_command))
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, collect_messages))
     
-    await application.initialize()
-    await application.start()
-    
-    # Set webhook
-    webhook_url = f"{WEBHOOK_URL}/{BOT_TOKEN}"
-    await application.bot.set_webhook(url=webhook_url)
-    logger.info(f"Webhook set to: {webhook_url}")
-
-def run_bot_async():
-    """Run bot initialization in a separate thread"""
-    global bot_loop
-    bot_loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(bot_loop)
-    bot_loop.run_until_complete(initialize_bot())
-    bot_loop.run_forever()
-
-@app.route('/')
-def index():
-    """Health check endpoint"""
-    return "Bot is running!", 200
-
-@app.route(f'/{BOT_TOKEN}', methods=['POST'])
-def webhook():
-    """Handle incoming updates from Telegram"""
-    try:
-        json_data = request.get_json()
-        update = Update.de_json(json_data, application.bot)
-        
-        # Process update in bot's event loop
-        asyncio.run_coroutine_threadsafe(
-            application.process_update(update),
-            bot_loop
-        )
-        
-        return "OK", 200
-    except Exception as e:
-        logger.error(f"Error processing update: {e}")
-        return "Error", 500
+    return application
 
 if __name__ == '__main__':
     if BOT_TOKEN == "YOUR_BOT_TOKEN_HERE":
         print("\n⚠️  ERROR: Please set BOT_TOKEN environment variable!")
         print("Get your token from @BotFather on Telegram\n")
     else:
-        # Start bot initialization in background thread
-        bot_thread = Thread(target=run_bot_async, daemon=True)
-        bot_thread.start()
+        # Faster event loop where available (uvloop has no Windows support)
+        try:
+            import uvloop
+            asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+        except ImportError:
+            pass
         
-        # Give the bot a moment to initialize
-        import time
-        time.sleep(2)
+        application = build_application()
         
-        # Start Flask server (this opens the port immediately)
-        logger.info(f"🤖 Bot webhook server starting on port {PORT}...")
-        app.run(host='0.0.0.0', port=PORT, debug=False)
+        # PTB serves the webhook itself and registers it with Telegram on startup
+        webhook_url = f"{WEBHOOK_URL}/{BOT_TOKEN}"
+        logger.info("🤖 Bot webhook server starting on port %s...", PORT)
+        application.run_webhook(
+            listen='0.0.0.0',
+            port=PORT,
+            url_path=BOT_TOKEN,
+            webhook_url=webhook_url
+        )